@@ -0,0 +1,3 @@
+from notifier.core import Config, run
+
+__all__ = ["Config", "run"]
@@ -0,0 +1,37 @@
+import argparse
+import os
+from dotenv import load_dotenv
+from notifier.core import Config, run
+
+def main() -> None:
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Put a message in a Matrix room when a GitLab MR gets a label")
+    parser.add_argument("--room-id", default=os.environ.get("MATRIX_ROOM_ID"), help="Matrix room to notify (default: $MATRIX_ROOM_ID)")
+    parser.add_argument("--label", default=os.environ.get("LABEL", "review:ready"), help="label marking MRs ready for review (default: %(default)s)")
+    parser.add_argument("--project-id", default=os.environ.get("PROJECT_ID", "1013"), help="GitLab project ID (default: %(default)s)")
+    parser.add_argument("--format", dest="matrix_format", choices=["html", "text"], default=os.environ.get("MATRIX_FORMAT", "html"), help="format of Matrix messages (default: %(default)s)")
+    args = parser.parse_args()
+
+    matrix_username: str | None = os.environ.get("MATRIX_USERNAME")
+    matrix_password: str | None = os.environ.get("MATRIX_PASSWORD")
+    if not (matrix_username and matrix_password and args.room_id):
+        parser.error("MATRIX_USERNAME, MATRIX_PASSWORD and a room ID (--room-id or MATRIX_ROOM_ID) are required")
+
+    run(Config(
+        matrix_username=matrix_username,
+        matrix_password=matrix_password,
+        matrix_room_id=args.room_id,
+        project_id=args.project_id,
+        gitlab_token=os.environ.get("GITLAB_TOKEN"),
+        label=args.label,
+        matrix_format=args.matrix_format,
+        check_interval=int(os.environ.get("CHECK_INTERVAL", 300)),
+        max_check_interval=int(os.environ.get("MAX_CHECK_INTERVAL", 3600)),
+        full_sweep_interval=int(os.environ.get("FULL_SWEEP_INTERVAL", 3600)),
+        webhook_secret=os.environ.get("GITLAB_WEBHOOK_SECRET"),
+        webhook_port=int(os.environ.get("WEBHOOK_PORT", 8080)),
+    ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+from dataclasses import dataclass
+from typing import Set, List, Dict, Any, Iterator, Literal
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import sqlite3
+import time
+import os
+import random
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from matrix_client.client import MatrixClient, Room
+
+STORAGE_FILE: str = "notified.db"
+# Notified MRs used to be stored as a JSON list, imported into STORAGE_FILE on first start
+LEGACY_STORAGE_FILE: str = "notified_mrs.json"
+ETAGS_FILE: str = "etags.json"
+# Number of GitLab requests that can be in flight at once
+GITLAB_CONCURRENCY: int = 4
+MRS_PER_PAGE: int = 100
+# Connect and read timeouts of GitLab requests, in seconds, so that a dead pooled connection can't hang the polling loop
+GITLAB_TIMEOUT: tuple[float, float] = (10, 30)
+
+@dataclass(frozen=True)
+class Config:
+    matrix_username: str
+    matrix_password: str
+    matrix_room_id: str
+    gitlab_url: str = "https://git.inpt.fr"
+    project_id: str = "1013"
+    gitlab_token: str | None = None
+    label: str = "review:ready"
+    matrix_homeserver: str = "https://matrix.inpt.fr"
+    matrix_format: Literal["html", "text"] = "html"
+    check_interval: int = 300
+    # Upper bound for the check interval, which doubles after every cycle where nothing changed
+    max_check_interval: int = 3600
+    # Between full sweeps, only MRs updated since the last check are fetched
+    full_sweep_interval: int = 3600
+    # Receive merge request events through a webhook instead of polling when set
+    webhook_secret: str | None = None
+    webhook_port: int = 8080
+
+# Reused across requests to keep the connection to GitLab alive
+SESSION: requests.Session = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=GITLAB_CONCURRENCY,
+    pool_maxsize=GITLAB_CONCURRENCY,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]),
+))
+
+# Response headers needed to paginate, kept alongside cached bodies since 304 responses may omit them
+PAGINATION_HEADERS: tuple[str, ...] = ("X-Total-Pages", "Link")
+
+# Query parameters left out of cache keys. updated_after changes on every active cycle, and keying on it would
+# grow the cache without bound. ETags depend on the response body, so sharing an entry across its values is safe.
+UNCACHED_PARAMS: tuple[str, ...] = ("updated_after",)
+
+# ETag, parsed body and pagination headers of the last successful response, by request URL
+etags_cache: Dict[str, tuple[str, Any, Dict[str, str]]] = {}
+# Whether etags_cache changed since it was last saved
+etags_cache_dirty: bool = False
+
+def write_json_atomically(path: str, data: Any) -> None:
+    # Write to a temporary file first so that a crash never leaves a truncated file behind
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(orjson.dumps(data))
+    os.replace(f"{path}.tmp", path)
+
+def open_storage() -> sqlite3.Connection:
+    db: sqlite3.Connection = sqlite3.connect(STORAGE_FILE, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS notified(iid INTEGER PRIMARY KEY)")
+    db.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)")
+
+    if os.path.exists(LEGACY_STORAGE_FILE):
+        with open(LEGACY_STORAGE_FILE, 'rb') as f:
+            db.executemany("INSERT OR IGNORE INTO notified VALUES (?)", [(iid,) for iid in orjson.loads(f.read())])
+        os.remove(LEGACY_STORAGE_FILE)
+
+    return db
+
+def load_notified_mrs(db: sqlite3.Connection) -> Set[int]:
+    return {iid for (iid,) in db.execute("SELECT iid FROM notified")}
+
+def is_notified(db: sqlite3.Connection, iid: int) -> bool:
+    return db.execute("SELECT 1 FROM notified WHERE iid = ?", (iid,)).fetchone() is not None
+
+def add_notified_mr(db: sqlite3.Connection, iid: int) -> None:
+    db.execute("INSERT OR IGNORE INTO notified VALUES (?)", (iid,))
+
+def remove_notified_mrs(db: sqlite3.Connection, iids: Set[int]) -> None:
+    if iids:
+        db.execute(f"DELETE FROM notified WHERE iid IN ({', '.join('?' * len(iids))})", tuple(iids))
+
+def load_last_seen(db: sqlite3.Connection) -> str | None:
+    row = db.execute("SELECT value FROM meta WHERE key = 'last_seen'").fetchone()
+    return row[0] if row else None
+
+def save_last_seen(db: sqlite3.Connection, last_seen: str) -> None:
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('last_seen', ?)", (last_seen,))
+
+def load_etags_cache() -> None:
+    global etags_cache_dirty
+    try:
+        with open(ETAGS_FILE, 'rb') as f:
+            saved: Dict[str, Any] = orjson.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        # Missing or unreadable, start from scratch
+        return
+
+    try:
+        # Entries keyed on parameters that are now left out of keys can never be hit again, drop them
+        etags_cache.update({url: (etag, body, headers) for url, (etag, body, headers) in saved.items() if etags_cache_key(url, {}) == url})
+    except ValueError:
+        # Written by an older version, start from scratch
+        etags_cache.clear()
+    etags_cache_dirty = len(etags_cache) != len(saved)
+
+def save_etags_cache() -> None:
+    global etags_cache_dirty
+    if etags_cache_dirty:
+        write_json_atomically(ETAGS_FILE, etags_cache)
+        etags_cache_dirty = False
+
+def etags_cache_key(url: str, params: Dict[str, Any]) -> str:
+    parts = urlsplit(requests.Request("GET", url, params=params).prepare().url or url)
+    query = [(name, value) for name, value in parse_qsl(parts.query) if name not in UNCACHED_PARAMS]
+    return parts._replace(query=urlencode(query)).geturl()
+
+def conditional_get(url: str, params: Dict[str, Any], revalidate: bool = True) -> tuple[Any, Dict[str, str], bool]:
+    """GET a JSON resource and its pagination headers, reusing the cached ones when GitLab answers 304 Not Modified.
+    Also tells whether the cached ones were reused. With revalidate=False, the resource is always downloaded."""
+    global etags_cache_dirty
+    key: str = etags_cache_key(url, params)
+    headers: Dict[str, str] = {}
+    if revalidate and key in etags_cache:
+        headers["If-None-Match"] = etags_cache[key][0]
+
+    response: requests.Response = SESSION.get(url, params=params, headers=headers, timeout=GITLAB_TIMEOUT)
+    if response.status_code == 304:
+        _, body, pagination = etags_cache[key]
+        return body, pagination, True
+
+    response.raise_for_status()
+    body = orjson.loads(response.content)
+    pagination = {name: response.headers[name] for name in PAGINATION_HEADERS if name in response.headers}
+    if etag := response.headers.get("ETag"):
+        etags_cache[key] = (etag, body, pagination)
+        etags_cache_dirty = True
+    return body, pagination, False
+
+def get_mrs_page(url: str, params: Dict[str, Any]) -> tuple[List[Dict[str, Any]], Dict[str, str]]:
+    # MRs can be added to later pages without changing a full page, so its cached pagination headers may be outdated
+    cached = etags_cache.get(etags_cache_key(url, params))
+    if cached and len(cached[1]) >= MRS_PER_PAGE and "X-Total-Pages" in cached[2]:
+        # The page count must be up to date before fetching the other pages, a 304 wouldn't give it
+        page, pagination, _ = conditional_get(url, params, revalidate=False)
+        return page, pagination
+
+    page, pagination, not_modified = conditional_get(url, params)
+    if not_modified and len(page) >= MRS_PER_PAGE and next_page_url(pagination) is None:
+        # Only the next page link matters here, and it can only be missing if this was the last page
+        page, pagination, _ = conditional_get(url, params, revalidate=False)
+    return page, pagination
+
+def next_page_url(pagination: Dict[str, str]) -> str | None:
+    for link in requests.utils.parse_header_links(pagination.get("Link", "")):
+        if link.get("rel") == "next":
+            return link["url"]
+    return None
+
+def fetch_mrs(config: Config, params: Dict[str, str]) -> Iterator[Dict[str, Any]]:
+    url: str = f"{config.gitlab_url}/api/v4/projects/{config.project_id}/merge_requests"
+    params = {**params, "per_page": str(MRS_PER_PAGE)}
+    
+    page, pagination = get_mrs_page(url, params)
+    yield from page
+
+    if "X-Total-Pages" in pagination:
+        # Fetch the remaining pages concurrently rather than one round-trip after the other
+        with ThreadPoolExecutor(max_workers=GITLAB_CONCURRENCY) as pool:
+            pages = pool.map(lambda number: conditional_get(url, {**params, "page": str(number)})[0], range(2, int(pagination["X-Total-Pages"]) + 1))
+            for page in pages:
+                yield from page
+        return
+
+    # GitLab leaves out X-Total-Pages when there are too many results to count, follow the next page links instead
+    while next_url := next_page_url(pagination):
+        page, pagination = get_mrs_page(next_url, {})
+        yield from page
+
+def fetch_ready_mrs(config: Config) -> List[Dict[str, Any]]:
+    return list(fetch_mrs(config, {"state": "opened", "labels": config.label}))
+
+def fetch_updated_mrs(config: Config, since: str) -> List[Dict[str, Any]]:
+    # Not filtered on state or label, since MRs that were closed, merged or unlabeled must be seen too
+    return list(fetch_mrs(config, {"state": "all", "updated_after": since}))
+
+def is_ready(config: Config, mr: Dict[str, Any]) -> bool:
+    return mr['state'] == 'opened' and config.label in mr['labels']
+
+def clean_notified_mrs(config: Config, db: sqlite3.Connection, mrs: List[Dict[str, Any]], full_sweep: bool) -> Set[int]:
+    notified_mrs: Set[int] = load_notified_mrs(db)
+    to_clean = notified_mrs & {mr['iid'] for mr in mrs if not is_ready(config, mr)}
+    if full_sweep:
+        # mrs lists every ready MR: any other notified MR was closed, merged or unlabeled
+        to_clean |= notified_mrs - {mr['iid'] for mr in mrs}
+    print(f"Removing from already-notified MRs {to_clean!r} (MR was closed, merged or {config.label} was removed)")
+    remove_notified_mrs(db, to_clean)
+    return notified_mrs - to_clean
+
+def sync_mrs(config: Config, room: Room, db: sqlite3.Connection, mrs: List[Dict[str, Any]], full_sweep: bool) -> None:
+    """Notify for newly ready MRs among mrs, and forget notified ones that are not ready anymore"""
+    ready_mrs: List[Dict[str, Any]] = [mr for mr in mrs if is_ready(config, mr)]
+    print(f"ready: {[mr['iid'] for mr in ready_mrs]}")
+
+    # Clean up notified MRs (closed or label removed)
+    notified_mrs: Set[int] = clean_notified_mrs(config, db, mrs, full_sweep)
+    print(f"{notified_mrs=}")
+    
+    # Check for new MRs with the ready label
+    for mr in ready_mrs:
+        mr_id: int = mr['iid']
+        if mr_id not in notified_mrs:
+            notify(config, room, mr_id, mr["title"], mr["web_url"])
+            add_notified_mr(db, mr_id)
+
+def notify(config: Config, room: Room, mr_id: int, title: str, url: str) -> None:
+    print(f"Notifying for !{mr_id}")
+    if config.matrix_format == "html":
+        room.send_html(f'New merge request ready for review: <a href="{url}">!{mr_id} {title}</a>', msgtype="m.notice")
+    else:
+        room.send_notice(f"New merge request ready for review: !{mr_id} {title} {url}")
+
+@dataclass(frozen=True)
+class MrEvent:
+    iid: int
+    state: str
+    labels: frozenset[str]
+    title: str
+    url: str
+    action: str | None
+
+def parse_mr_event(payload: Dict[str, Any]) -> MrEvent:
+    """Pick what handle_mr_event needs from a merge request event, raising KeyError or TypeError if it's malformed"""
+    attributes: Dict[str, Any] = payload["object_attributes"]
+    event = MrEvent(
+        iid=attributes["iid"],
+        state=attributes["state"],
+        labels=frozenset(label["title"] for label in payload.get("labels", [])),
+        title=attributes["title"],
+        url=attributes["url"],
+        action=attributes.get("action"),
+    )
+    if not (isinstance(event.iid, int) and all(isinstance(value, str) for value in (event.state, event.title, event.url))):
+        raise TypeError("Unexpected merge request attribute types")
+    return event
+
+def handle_mr_event(config: Config, room: Room, db: sqlite3.Connection, event: MrEvent) -> None:
+    ready: bool = event.state == "opened" and config.label in event.labels
+
+    if ready and not is_notified(db, event.iid):
+        notify(config, room, event.iid, event.title, event.url)
+        add_notified_mr(db, event.iid)
+    elif not ready:
+        print(f"Removing !{event.iid} from already-notified MRs, if needed (action: {event.action})")
+        remove_notified_mrs(db, {event.iid})
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def __init__(self, config: Config, room: Room, db: sqlite3.Connection, *args: Any, **kwargs: Any) -> None:
+        self.config = config
+        self.room = room
+        self.db = db
+        super().__init__(*args, **kwargs)
+
+    def do_POST(self) -> None:
+        if self.path != "/gitlab-webhook":
+            self.send_error(404)
+            return
+
+        # Compared as bytes, since compare_digest refuses non-ASCII strings
+        token: bytes = self.headers.get("X-Gitlab-Token", "").encode()
+        if not hmac.compare_digest(token, (self.config.webhook_secret or "").encode()):
+            self.send_error(401)
+            return
+
+        try:
+            payload: Any = orjson.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError:
+            self.send_error(400)
+            return
+
+        if not isinstance(payload, dict):
+            self.send_error(400)
+            return
+
+        if payload.get("object_kind") == "merge_request":
+            try:
+                event: MrEvent = parse_mr_event(payload)
+            except (KeyError, TypeError):
+                self.send_error(400)
+                return
+
+            try:
+                handle_mr_event(self.config, self.room, self.db, event)
+            except Exception as e:
+                print(f"Error occurred: {e}")
+                self.send_error(500)
+                return
+
+        self.send_response(200)
+        self.end_headers()
+
+def serve_webhook(config: Config, room: Room, db: sqlite3.Connection) -> None:
+    server: HTTPServer = HTTPServer(("", config.webhook_port), partial(WebhookHandler, config, room, db))
+    print(f"Listening for GitLab merge request events on port {config.webhook_port}")
+
+    # GitLab doesn't redeliver events sent while the listener was down, catch up with a full sweep first.
+    # The server is already bound, so events sent in the meantime wait to be handled instead of being lost.
+    try:
+        sync_mrs(config, room, db, fetch_ready_mrs(config), full_sweep=True)
+    except Exception as e:
+        print(f"Error occurred while catching up with GitLab: {e}")
+
+    server.serve_forever()
+
+def run(config: Config) -> None:
+    if config.gitlab_token:
+        SESSION.headers["PRIVATE-TOKEN"] = config.gitlab_token
+
+    # Set up Matrix client
+    client: MatrixClient = MatrixClient(config.matrix_homeserver)
+    client.login(username=config.matrix_username, password=config.matrix_password)
+    # The bot stays in the same room, join it once instead of before every message
+    room: Room = client.join_room(config.matrix_room_id)
+
+    db: sqlite3.Connection = open_storage()
+    
+    # Receive merge request events from GitLab instead of polling, if a webhook is configured
+    if config.webhook_secret:
+        serve_webhook(config, room, db)
+        return
+
+    load_etags_cache()
+
+    last_seen: str | None = load_last_seen(db)
+    last_full_sweep: float | None = None
+    interval: int = config.check_interval
+    last_hash: int | None = None
+    consecutive_errors: int = 0
+    
+    while True:
+        print("Checking for MRs to notify / remove from notified MRs")
+        try:
+            # Only look at MRs updated since the last check, except for a regular full sweep in case an update was missed
+            full_sweep: bool = last_seen is None or last_full_sweep is None or time.monotonic() - last_full_sweep >= config.full_sweep_interval
+            sweep_started: float = time.monotonic()
+            mrs: List[Dict[str, Any]] = fetch_ready_mrs(config) if full_sweep else fetch_updated_mrs(config, last_seen)
+            print("Full sweep" if full_sweep else f"Updated since {last_seen}")
+            sync_mrs(config, room, db, mrs, full_sweep)
+            
+            if mrs:
+                # Timestamps are all formatted the same way by GitLab, so they compare as strings
+                last_seen = max([mr['updated_at'] for mr in mrs] + ([last_seen] if last_seen else []))
+                save_last_seen(db, last_seen)
+            if full_sweep:
+                last_full_sweep = sweep_started
+            save_etags_cache()
+            consecutive_errors = 0
+
+            # Back off while nothing happens, go back to checking often as soon as something does.
+            # Full sweeps and incremental checks return different lists, so compare what they lead to instead.
+            current_hash: int = hash((frozenset(load_notified_mrs(db)), last_seen))
+            interval = min(interval * 2, config.max_check_interval) if current_hash == last_hash else config.check_interval
+            last_hash = current_hash
+            print(f"Will check again in {interval} seconds", end="\n\n\n")
+            time.sleep(interval)
+            
+        except Exception as e:
+            print(f"Error occurred: {e}")
+            # Wait longer after each consecutive error, with jitter so that restarts don't hit GitLab all at once
+            delay: float = min(60 * 2**consecutive_errors, 3600) * random.uniform(0.8, 1.2)
+            consecutive_errors += 1
+            print(f"Will try again in {delay:.0f} seconds")
+            time.sleep(delay)
@@ -0,0 +1,294 @@
+import hashlib
+import io
+import os
+import tempfile
+import unittest
+from typing import Any, Dict, List
+from unittest import mock
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import orjson
+
+from notifier import core
+
+CONFIG = core.Config(matrix_username="bot", matrix_password="password", matrix_room_id="!room:example.org")
+MRS_URL = f"{CONFIG.gitlab_url}/api/v4/projects/{CONFIG.project_id}/merge_requests"
+
+def make_mr(iid: int, state: str = "opened", labels: List[str] | None = None) -> Dict[str, Any]:
+    return {
+        "iid": iid,
+        "state": state,
+        "labels": ["review:ready"] if labels is None else labels,
+        "title": f"MR {iid}",
+        "web_url": f"https://git.example.org/mr/{iid}",
+        "updated_at": f"2024-01-01T00:00:{iid % 60:02d}.000Z",
+    }
+
+class FakeResponse:
+    def __init__(self, status_code: int, body: Any, headers: Dict[str, str]) -> None:
+        self.status_code = status_code
+        self.content = b"" if body is None else orjson.dumps(body)
+        self.headers = headers
+
+    def raise_for_status(self) -> None:
+        pass
+
+class FakeGitLab:
+    """Serves self.mrs paginated like GitLab, with ETags derived from response bodies"""
+
+    def __init__(self, mrs: List[Dict[str, Any]], total_pages_header: bool = True) -> None:
+        self.mrs = mrs
+        self.total_pages_header = total_pages_header
+        # Page number and whether If-None-Match was sent, for every request
+        self.requests: List[tuple[int, bool]] = []
+
+    def __call__(self, url: str, params: Dict[str, Any], headers: Dict[str, str], timeout: Any) -> FakeResponse:
+        query: Dict[str, str] = {**dict(parse_qsl(urlsplit(url).query)), **params}
+        page: int = int(query.get("page", 1))
+        per_page: int = int(query["per_page"])
+        self.requests.append((page, "If-None-Match" in headers))
+
+        body = self.mrs[(page - 1) * per_page:page * per_page]
+        etag: str = f'W/"{hashlib.md5(orjson.dumps(body)).hexdigest()}"'
+        if headers.get("If-None-Match") == etag:
+            return FakeResponse(304, None, {"ETag": etag})
+
+        total_pages: int = max(1, -(-len(self.mrs) // per_page))
+        response_headers: Dict[str, str] = {"ETag": etag}
+        if self.total_pages_header:
+            response_headers["X-Total-Pages"] = str(total_pages)
+        if page < total_pages:
+            next_query = urlencode({**query, "page": str(page + 1)})
+            response_headers["Link"] = f'<{urlsplit(url)._replace(query=next_query).geturl()}>; rel="next"'
+        return FakeResponse(200, body, response_headers)
+
+class NotifierTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for name, filename in (("ETAGS_FILE", "etags.json"), ("STORAGE_FILE", "notified.db"), ("LEGACY_STORAGE_FILE", "notified_mrs.json")):
+            patcher = mock.patch.object(core, name, os.path.join(directory.name, filename))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        core.etags_cache.clear()
+        core.etags_cache_dirty = False
+        self.addCleanup(core.etags_cache.clear)
+
+    def use_gitlab(self, gitlab: FakeGitLab) -> FakeGitLab:
+        patcher = mock.patch.object(core.SESSION, "get", gitlab)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return gitlab
+
+class EtagsCacheKeyTest(NotifierTestCase):
+    def test_leaves_out_updated_after(self) -> None:
+        self.assertEqual(
+            core.etags_cache_key(MRS_URL, {"state": "all", "updated_after": "2024-01-01T00:00:00Z"}),
+            core.etags_cache_key(MRS_URL, {"state": "all", "updated_after": "2024-02-01T00:00:00Z"}),
+        )
+
+    def test_same_key_for_query_in_url_or_params(self) -> None:
+        self.assertEqual(
+            core.etags_cache_key(f"{MRS_URL}?state=all&updated_after=2024&page=2", {}),
+            core.etags_cache_key(MRS_URL, {"state": "all", "page": "2"}),
+        )
+
+    def test_keeps_other_params(self) -> None:
+        self.assertNotEqual(
+            core.etags_cache_key(MRS_URL, {"state": "opened", "labels": "review:ready"}),
+            core.etags_cache_key(MRS_URL, {"state": "opened"}),
+        )
+
+class EtagsCachePersistenceTest(NotifierTestCase):
+    def write_cache_file(self, data: Any) -> None:
+        with open(core.ETAGS_FILE, 'wb') as f:
+            f.write(orjson.dumps(data))
+
+    def test_round_trip(self) -> None:
+        self.use_gitlab(FakeGitLab([make_mr(1)]))
+        core.conditional_get(MRS_URL, {"per_page": "100"})
+        core.save_etags_cache()
+        saved = dict(core.etags_cache)
+
+        core.etags_cache.clear()
+        core.load_etags_cache()
+        self.assertEqual(core.etags_cache, saved)
+        self.assertFalse(core.etags_cache_dirty)
+
+    def test_drops_entries_keyed_on_uncached_params(self) -> None:
+        kept: str = core.etags_cache_key(MRS_URL, {"state": "opened"})
+        self.write_cache_file({
+            kept: ["etag-1", [], {}],
+            f"{MRS_URL}?state=all&updated_after=2024": ["etag-2", [], {}],
+        })
+        core.load_etags_cache()
+        self.assertEqual(list(core.etags_cache), [kept])
+        self.assertTrue(core.etags_cache_dirty)
+
+    def test_ignores_older_format(self) -> None:
+        self.write_cache_file({MRS_URL: ["etag", []]})
+        core.load_etags_cache()
+        self.assertEqual(core.etags_cache, {})
+
+    def test_only_saves_when_changed(self) -> None:
+        gitlab = self.use_gitlab(FakeGitLab([make_mr(1)]))
+        core.conditional_get(MRS_URL, {"per_page": "100"})
+        core.save_etags_cache()
+        os.remove(core.ETAGS_FILE)
+
+        core.conditional_get(MRS_URL, {"per_page": "100"})
+        core.save_etags_cache()
+        self.assertEqual(gitlab.requests, [(1, False), (1, True)])
+        self.assertFalse(os.path.exists(core.ETAGS_FILE))
+
+class ConditionalGetTest(NotifierTestCase):
+    def test_reuses_cached_body_on_304(self) -> None:
+        gitlab = self.use_gitlab(FakeGitLab([make_mr(1)]))
+        body, _, not_modified = core.conditional_get(MRS_URL, {"per_page": "100"})
+        self.assertFalse(not_modified)
+
+        cached_body, _, not_modified = core.conditional_get(MRS_URL, {"per_page": "100"})
+        self.assertTrue(not_modified)
+        self.assertIs(cached_body, body)
+        self.assertEqual(gitlab.requests, [(1, False), (1, True)])
+
+    def test_downloads_changed_body(self) -> None:
+        gitlab = self.use_gitlab(FakeGitLab([make_mr(1)]))
+        core.conditional_get(MRS_URL, {"per_page": "100"})
+        gitlab.mrs = [make_mr(2)]
+
+        body, _, not_modified = core.conditional_get(MRS_URL, {"per_page": "100"})
+        self.assertFalse(not_modified)
+        self.assertEqual([mr["iid"] for mr in body], [2])
+
+class FetchMrsTest(NotifierTestCase):
+    def test_fetches_every_page_with_total_pages(self) -> None:
+        self.use_gitlab(FakeGitLab([make_mr(iid) for iid in range(250)]))
+        self.assertEqual([mr["iid"] for mr in core.fetch_ready_mrs(CONFIG)], list(range(250)))
+
+    def test_follows_links_without_total_pages(self) -> None:
+        self.use_gitlab(FakeGitLab([make_mr(iid) for iid in range(350)], total_pages_header=False))
+        self.assertEqual([mr["iid"] for mr in core.fetch_ready_mrs(CONFIG)], list(range(350)))
+
+    def test_sees_pages_added_behind_an_unchanged_first_page(self) -> None:
+        for total_pages_header in (True, False):
+            with self.subTest(total_pages_header=total_pages_header):
+                core.etags_cache.clear()
+                gitlab = self.use_gitlab(FakeGitLab([make_mr(iid) for iid in range(200)], total_pages_header))
+                core.fetch_ready_mrs(CONFIG)
+                gitlab.mrs.append(make_mr(200))
+                self.assertEqual(len(core.fetch_ready_mrs(CONFIG)), 201)
+
+    def test_unchanged_cycle_with_total_pages_costs_one_request_per_page(self) -> None:
+        gitlab = self.use_gitlab(FakeGitLab([make_mr(iid) for iid in range(250)]))
+        core.fetch_ready_mrs(CONFIG)
+        gitlab.requests.clear()
+
+        core.fetch_ready_mrs(CONFIG)
+        # The full first page is downloaded again for an up-to-date page count, the others are revalidated
+        self.assertEqual(sorted(gitlab.requests), [(1, False), (2, True), (3, True)])
+
+    def test_unchanged_cycle_with_links_costs_one_request_per_page(self) -> None:
+        gitlab = self.use_gitlab(FakeGitLab([make_mr(iid) for iid in range(350)], total_pages_header=False))
+        core.fetch_ready_mrs(CONFIG)
+        gitlab.requests.clear()
+
+        core.fetch_ready_mrs(CONFIG)
+        self.assertEqual(gitlab.requests, [(1, True), (2, True), (3, True), (4, True)])
+
+class SyncMrsTest(NotifierTestCase):
+    def test_full_sweep_notifies_new_and_forgets_stale_mrs(self) -> None:
+        self.use_gitlab(FakeGitLab([make_mr(1), make_mr(2)]))
+        db = core.open_storage()
+        self.addCleanup(db.close)
+        room = mock.Mock()
+        core.add_notified_mr(db, 1)
+        core.add_notified_mr(db, 99)
+
+        core.sync_mrs(CONFIG, room, db, core.fetch_ready_mrs(CONFIG), full_sweep=True)
+        self.assertEqual(core.load_notified_mrs(db), {1, 2})
+        room.send_html.assert_called_once()
+        self.assertIn("!2 MR 2", room.send_html.call_args.args[0])
+
+class HandleMrEventTest(NotifierTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db = core.open_storage()
+        self.addCleanup(self.db.close)
+        self.room = mock.Mock()
+
+    def event(self, state: str = "opened", labels: List[str] | None = None) -> core.MrEvent:
+        return core.parse_mr_event({
+            "object_kind": "merge_request",
+            "labels": [{"title": label} for label in (["review:ready"] if labels is None else labels)],
+            "object_attributes": {"iid": 4, "state": state, "title": "MR 4", "url": "https://git.example.org/mr/4", "action": "update"},
+        })
+
+    def test_notifies_once(self) -> None:
+        core.handle_mr_event(CONFIG, self.room, self.db, self.event())
+        core.handle_mr_event(CONFIG, self.room, self.db, self.event())
+        self.room.send_html.assert_called_once()
+        self.assertEqual(core.load_notified_mrs(self.db), {4})
+
+    def test_forgets_unlabeled_and_merged_mrs(self) -> None:
+        for event in (self.event(labels=[]), self.event(state="merged")):
+            with self.subTest(event=event):
+                core.add_notified_mr(self.db, 4)
+                core.handle_mr_event(CONFIG, self.room, self.db, event)
+                self.assertEqual(core.load_notified_mrs(self.db), set())
+                self.room.send_html.assert_not_called()
+
+class WebhookHandlerTest(NotifierTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.db = core.open_storage()
+        self.addCleanup(self.db.close)
+        self.room = mock.Mock()
+        self.config = core.Config(matrix_username="bot", matrix_password="password", matrix_room_id="!room:example.org", webhook_secret="secret")
+
+    def post(self, body: bytes, token: bytes = b"secret") -> int:
+        """Run the handler on a raw HTTP request and return the response's status code"""
+        request = io.BytesIO(
+            b"POST /gitlab-webhook HTTP/1.1\r\n"
+            b"X-Gitlab-Token: " + token + b"\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+        response = io.BytesIO()
+        connection = mock.Mock()
+        connection.makefile.return_value = request
+        connection.sendall.side_effect = response.write
+        with mock.patch.object(core.WebhookHandler, "log_message"):
+            core.WebhookHandler(self.config, self.room, self.db, connection, ("127.0.0.1", 0), mock.Mock())
+        return int(response.getvalue().split(b" ")[1])
+
+    def test_rejects_wrong_tokens(self) -> None:
+        for token in (b"wrong", "\u00e9".encode("latin-1")):
+            with self.subTest(token=token):
+                self.assertEqual(self.post(b"{}", token), 401)
+
+    def test_rejects_malformed_payloads(self) -> None:
+        for body in (b"not json", b"[1, 2]", b'{"object_kind": "merge_request"}', b'{"object_kind": "merge_request", "object_attributes": {"iid": "4"}}'):
+            with self.subTest(body=body):
+                self.assertEqual(self.post(body), 400)
+
+    def test_handles_merge_request_events(self) -> None:
+        body = orjson.dumps({
+            "object_kind": "merge_request",
+            "labels": [{"title": "review:ready"}],
+            "object_attributes": {"iid": 4, "state": "opened", "title": "MR 4", "url": "https://git.example.org/mr/4", "action": "update"},
+        })
+        self.assertEqual(self.post(body), 200)
+        self.assertEqual(core.load_notified_mrs(self.db), {4})
+
+    def test_reports_handler_failures(self) -> None:
+        self.room.send_html.side_effect = RuntimeError("Matrix is down")
+        body = orjson.dumps({
+            "object_kind": "merge_request",
+            "labels": [{"title": "review:ready"}],
+            "object_attributes": {"iid": 4, "state": "opened", "title": "MR 4", "url": "https://git.example.org/mr/4"},
+        })
+        self.assertEqual(self.post(body), 500)
+
+if __name__ == "__main__":
+    unittest.main()